@@ -1,8 +1,12 @@
-import itertools
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import time
 import os
 from netCDF4 import Dataset
 import numpy as np
+import scipy.sparse
+from numba import njit
 from datetime import datetime
 import seissolxdmf
 import trimesh
@@ -10,9 +14,18 @@ import trimesh.proximity
 import trimesh.ray
 import trimesh.viewer
 import trimesh.creation
+try:
+    # embreex is the maintained fork of pyembree used by recent trimesh versions, both share the same API
+    from embreex import rtcore_scene
+    from embreex.mesh_construction import TriangleMesh
+except ImportError:
+    try:
+        from pyembree import rtcore_scene
+        from pyembree.mesh_construction import TriangleMesh
+    except ImportError:
+        rtcore_scene = None  # only needed to cast rays, see EmbreeIntersector
 from pyproj import Transformer
 import rasterio
-import bisect
 
 
 def grdwrite(x, y, z, foutput):
@@ -57,26 +70,26 @@ def grdwrite(x, y, z, foutput):
 
 def getBarycentricCoord(pto, vert_a, vert_b, vert_c):
     """
-    Function returning a list of the barycentric coordinates of a 2D point within a 2D triangle
+    Function returning the barycentric coordinates of 2D points within 2D triangles. It works either on a single
+    point and triangle or on arrays of dim(n,2) holding one point and one triangle per row
 
     :param pto: point within the trinagle
     :param vert_a: vertex a
     :param vert_b: vertex b
     :param vert_c: vertex c
-    :return: list of the three barycentric coordinates of pto respecto to vertex a, vertex b and vertex c
+    :return: array of dim(...,3) of the three barycentric coordinates of pto respecto to vertex a, vertex b and vertex c
     """
     ab = vert_b - vert_a
     ac = vert_c - vert_a
     ap = pto - vert_a
 
-    normal_ac = [vert_a[1] - vert_c[1], vert_c[0] - vert_a[0]]
-    normal_ab = [vert_a[1] - vert_b[1], vert_b[0] - vert_a[0]]
-
-    bary_beta = np.dot(ap, normal_ac) / np.dot(ab, normal_ac)
-    bary_gamma = np.dot(ap, normal_ab) / np.dot(ac, normal_ab)
+    # 2D cross products, i.e. dot products against the normals of ab and ac
+    area = ab[..., 0] * ac[..., 1] - ab[..., 1] * ac[..., 0]
+    bary_beta = (ap[..., 0] * ac[..., 1] - ap[..., 1] * ac[..., 0]) / area
+    bary_gamma = (ab[..., 0] * ap[..., 1] - ab[..., 1] * ap[..., 0]) / area
     bary_alpha = 1.000 - bary_beta - bary_gamma
 
-    return [bary_alpha, bary_beta, bary_gamma]
+    return np.stack([bary_alpha, bary_beta, bary_gamma], axis=-1)
 
 
 def generateMesh3DfromSeissol(path2SeissolOutput):
@@ -106,15 +119,54 @@ def generateMesh2DfromSeissol(path2SeissolOutput):
     sx = seissolxdmf.seissolxdmf(path2SeissolOutput)
     nodes_seissol3d = sx.ReadGeometry()  # nodes array
     faces_seissol3d = sx.ReadConnect()  # connectivity array
-    N_nodes = len(nodes_seissol3d)
 
-    nodos_seissol2d = np.delete(nodes_seissol3d, 2, 1)  # remove last component
-    nodos_seissol2d = np.c_[nodos_seissol2d, np.zeros(N_nodes)]  # add z=0 to each node to keep working on 3D
+    # keep the (x,y) components and add z=0 to each node to keep working on 3D, in a single allocation
+    nodos_seissol2d = planar_vertices(nodes_seissol3d[:, 0], nodes_seissol3d[:, 1])
 
     mesh2d = trimesh.Trimesh(vertices=nodos_seissol2d, faces=faces_seissol3d, process=False)
     return mesh2d
 
 
+@functools.lru_cache(maxsize=None)
+def wgs84_transformer(inputcrs):
+    """
+    Return the transformer from inputcrs to WGS84. Transformers are cached, so each CRS is only initialized once
+
+    :param inputcrs: CRS of the input coordinates
+    :return: pyproj Transformer object
+    """
+    return Transformer.from_crs(inputcrs, "epsg:4326", always_xy=True)
+
+
+def planar_vertices(xs, ys):
+    """
+    Return the nodes array of a 2D-essentially mesh (z=0) from the x and y coordinates of its nodes
+
+    :param xs: 1D array of x coordinates
+    :param ys: 1D array of y coordinates
+    :return: array of dim(n,3) with last component z=0
+    """
+    vertices = np.empty((len(xs), 3))
+    vertices[:, 0] = xs
+    vertices[:, 1] = ys
+    vertices[:, 2] = 0.0  # keep z=0 to keep working on 3D
+    return vertices
+
+
+def nodesCRSconversion(xs, ys, meshCRS):
+    """
+    Transform the x and y coordinates of a set of nodes to CRS WGS84
+
+    :param xs: 1D array of x coordinates
+    :param ys: 1D array of y coordinates
+    :param meshCRS: CRS of the nodes
+    :return: 1D arrays of the longitude and latitude coordinates
+    """
+    transformer = wgs84_transformer(meshCRS)
+    # contiguous arrays are transformed by PROJ without internal copies
+    return transformer.transform(np.ascontiguousarray(xs), np.ascontiguousarray(ys))
+
+
 def mesh2dCRSconversion(mesh2d, meshCRS):
     """
     Generate a new 2D mesh in CRS WGS84
@@ -123,59 +175,197 @@ def mesh2dCRSconversion(mesh2d, meshCRS):
     :param meshCRS:
     :return: new trimesh object in the new CRS
     """
-    transformer = Transformer.from_crs(meshCRS, "epsg:4326", always_xy=True)
     nodes_utm = mesh2d.vertices
-    x = nodes_utm[:, 0]
-    y = nodes_utm[:, 1]
+    xnew, ynew = nodesCRSconversion(nodes_utm[:, 0], nodes_utm[:, 1], meshCRS)
 
-    xnew, ynew = transformer.transform(x, y)
+    mesh2d_wgs = trimesh.Trimesh(vertices=planar_vertices(xnew, ynew), faces=mesh2d.faces, process=False)
 
-    nodes_wgs = np.array([[m, n] for m, n in zip(xnew, ynew)])
-    nodes_wgs = np.c_[nodes_wgs, np.zeros(len(nodes_wgs))]
+    return mesh2d_wgs
 
-    mesh2d_wgs = trimesh.Trimesh(vertices=nodes_wgs, faces=mesh2d.faces, process=False)
 
-    return mesh2d_wgs
+def load_meshes(path2SeissolOutput, meshCRS):
+    """
+    Read the SeisSol nodes and connectivity arrays once and return the 3D mesh and the coordinates of its nodes
+    in WGS84. The 2D mesh in WGS84 is given by these coordinates and the faces of the 3D mesh
 
+    :param path2SeissolOutput:  path to the file .xdmf generated by SeisSol. Same folder must contain
+                                the files of the vertex and cell information
+    :param meshCRS: CRS of the SeisSol mesh
+    :return: trimesh 3d object and 1D arrays of the longitude and latitude coordinates of its nodes
+    """
+    sx = seissolxdmf.seissolxdmf(path2SeissolOutput)
+    nodes_seissol3d = sx.ReadGeometry()  # nodes array
+    faces_seissol3d = sx.ReadConnect()  # connectivity array
+    mesh3d = trimesh.Trimesh(vertices=nodes_seissol3d, faces=faces_seissol3d, process=False)
+
+    xs_wgs, ys_wgs = nodesCRSconversion(nodes_seissol3d[:, 0], nodes_seissol3d[:, 1], meshCRS)
+    return mesh3d, xs_wgs, ys_wgs
+
+
+def nodes_weights_matrix(mesh3d):
+    """
+    This function builds the sparse matrix mapping the faces values of a 3D triangular mesh to its nodes values.
+    Each node value is the weighted mean of the values of the faces that contain the node as a vertex, using
+    the faces areas as weights
 
-def assign_nodes_values(path2SeissolOutput, mesh3d, variable, instant):
+    :param mesh3d: trimesh 3d object
+    :return: scipy sparse matrix of dim(Nnodes, Nfaces) whose rows add up to 1. Rows of nodes that do not belong
+    to any face (or only to faces of zero area) add up to 0
+    """
+    area_triangles = mesh3d.area_faces
+    n_faces = len(mesh3d.faces)
+    # each face contributes with its area to its three vertices
+    weights = scipy.sparse.csr_matrix((np.repeat(area_triangles, 3),
+                                       (mesh3d.faces.ravel(), np.repeat(np.arange(n_faces), 3))),
+                                      shape=(len(mesh3d.vertices), n_faces))
+    total_shared_area = np.asarray(weights.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore'):
+        inverse_area = 1.0 / total_shared_area
+    inverse_area[total_shared_area == 0] = 0.0  # no weighted mean is possible for these nodes
+    return scipy.sparse.diags(inverse_area) @ weights
+
+
+def assign_nodes_values(path2SeissolOutput, mesh3d, variable, weights=None):
     """
     This function assigns values to the nodes of a 3D triangular mesh based on a weighted mean using
-    the faces areas that contain each node as a vertex
+    the faces areas that contain each node as a vertex. All the timesteps are computed at once
 
     :param path2SeissolOutput: path to the file .xdmf generated by SeisSol. Same folder must contain
                         the files of the vertex and cell information
     :param mesh3d: trimesh 3d object
     :param variable: string name of one of the variables provided by SeisSol
-    :param instant: timestep of the SeisSol output
-    :return: .npy file of the assigned values to the nodes. The name is "node_values_[variable]_timestep[instant]"
-    and will be saved on the current directory
+    :param weights: matrix returned by nodes_weights_matrix(mesh3d). It is built if not provided
+    :return: .npy file of dim(ndt, Nnodes) of the assigned values to the nodes, one row per timestep. The name
+    is "node_values_[variable]" and will be saved on the "nodes_arrays" directory
     """
     sx = seissolxdmf.seissolxdmf(path2SeissolOutput)  # open the SeisSol output to read the variable
-    values = sx.ReadData(variable)  # read the variable
-    area_triangles = mesh3d.area_faces
-    nodes_value = []
-    for i in range(0, len(mesh3d.vertices)):
-        shared_faces = mesh3d.vertex_faces[i]  # face indexes that have node_i in common
-        shared_faces = np.delete(shared_faces, np.where(shared_faces == -1))  # remove indexes -1
-        total_shared_area = 0.0
-        value_acum = 0.0
-        for j in range(0, len(shared_faces)):
-            area_j = area_triangles[shared_faces[j]]  # adyacent face area
-            v_j = values[instant][shared_faces[j]]  # variable value in the selected instant and selected face
-            value_acum += v_j * area_j
-            total_shared_area += area_j
-        # final value to associate to the node after the weighted mean:
-        final_node_value = value_acum / total_shared_area
-        nodes_value.append(final_node_value)
-    nodes_value = np.asarray(nodes_value)  # array containing the nodes values
+    values = sx.ReadData(variable)  # read the variable, array of dim(ndt, Nfaces)
+    if weights is None:
+        weights = nodes_weights_matrix(mesh3d)
+    nodes_values = (weights @ values.T).T  # array of dim(ndt, Nnodes)
+    nodes_values[:, np.asarray(weights.sum(axis=1)).ravel() == 0] = np.nan  # nodes without faces area
     if not os.path.exists("nodes_arrays"):
         os.mkdir("nodes_arrays")
-    np.save("nodes_arrays/node_values_{}_timestep{}".format(variable, instant), nodes_value)
-    outfile = "node_values_{}_timestep{}.npy".format(variable, instant)
+    np.save("nodes_arrays/node_values_{}".format(variable), nodes_values)
+    outfile = "node_values_{}.npy".format(variable)
     return outfile
 
 
+class EmbreeIntersector:
+    """
+    Thin wrapper of an embree scene (embreex or pyembree) offering the intersects_first method of trimesh
+    RayMeshIntersector. It is built directly from the nodes and faces arrays, skipping the trimesh object and
+    its caches
+    """
+
+    def __init__(self, vertices, faces):
+        """
+        :param vertices: array of dim(Nnodes,3) of the mesh nodes
+        :param faces: array of dim(Nfaces,3) of the mesh connectivity
+        """
+        if rtcore_scene is None:
+            raise ImportError("embreex or pyembree is required to locate points within the mesh")
+        # embree works in single precision, moving the mesh to the origin keeps most of it
+        self.shift = vertices.min(axis=0)
+        self.scene = rtcore_scene.EmbreeScene()
+        TriangleMesh(scene=self.scene, vertices=(vertices - self.shift).astype(np.float32),
+                     indices=np.asarray(faces).astype(np.int32))
+
+    def intersects_first(self, ray_origins, ray_directions):
+        """
+        Return the index of the first triangle hit by each ray, -1 if the ray misses the mesh
+
+        :param ray_origins: array of dim(n,3) of the rays origins
+        :param ray_directions: array of dim(n,3) of the rays unit directions
+        :return: array of dim(n,) of triangles indexes
+        """
+        return self.scene.run((ray_origins - self.shift).astype(np.float32), ray_directions.astype(np.float32))
+
+
+def locate_pointCloud(points, xs, ys, faces):
+    """
+    This function locates a given set of 2D points (z=0) within an 2D-essentially mesh (z=0). For each point it
+    returns the nodes of the triangle that contains it and its barycentric coordinates in that triangle, which
+    only depend on the mesh geometry and can be reused to interpolate any set of values associated to the nodes.
+    Points missed by pyembree are retried with the trimesh native intersector if rtree is installed, and then
+    with a slightly shifted origin
+
+    :param points: array of dim(n,3) with last component z=-1. (x,y) coordinates must be located inside the 2D mesh!!
+    :param xs: 1D array of x coordinates of the mesh nodes
+    :param ys: 1D array of y coordinates of the mesh nodes
+    :param faces: array of dim(Nfaces,3) of the mesh connectivity
+    :return: array of dim(n,3) of the nodes indexes of the triangle containing each point and array of dim(n,3)
+    of the barycentric coordinates of each point respect to those nodes (NaN for points outside the mesh)
+    """
+    vertices = planar_vertices(xs, ys)
+    rays = EmbreeIntersector(vertices, faces)  # ray object from pyembree
+    # Next line cast a ray from point in the z direction and get the triangle index that intersects
+    directions = np.tile([[0., 0., 1.]], (len(points), 1))
+    face_indexes = rays.intersects_first(points, directions)  # list of triangles indexes
+    missing = np.flatnonzero(face_indexes == -1)
+    if len(missing):
+        # pyembree works in single precision and may miss points lying on the triangles edges. Retry them
+        # with the slower, double precision, native intersector. It needs the optional rtree package, without
+        # it the points go straight to the last resort below
+        mesh2d = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+        rays_native = trimesh.ray.ray_triangle.RayMeshIntersector(mesh2d)
+        try:
+            face_indexes[missing] = rays_native.intersects_first(points[missing], directions[missing])
+            missing = missing[face_indexes[missing] == -1]
+        except ImportError:
+            pass
+    if len(missing):
+        # last resort: retry the remaining points with a slightly shifted origin
+        eps = 0.0000925925925926  # ~10m
+        face_indexes[missing] = rays.intersects_first(points[missing] + eps, directions[missing])
+        missing = missing[face_indexes[missing] == -1]
+
+    face_nodes = faces[face_indexes]  # (n,3) nodes indexes of the face containing each point
+    # Barycentric coordinates are invariants under plane-projections
+    triangles = vertices[face_nodes][:, :, :2]  # (n,3,2) cartesian coordinates of the face nodes
+    bar_coord = getBarycentricCoord(points[:, :2], triangles[:, 0], triangles[:, 1], triangles[:, 2])
+    if len(missing):
+        print("{} points are outside the mesh, their interpolated values will be NaN".format(len(missing)))
+        bar_coord[missing] = np.nan
+    return face_nodes, bar_coord
+
+
+@njit(nogil=True, cache=True)
+def barycentric_kernel(face_nodes, bar_coord, nodes_values, out):
+    """
+    Compiled loop of barycentric_interpolation. It gathers the nodes values and combines them in a single pass
+    over the points without temporary arrays, and releases the GIL so several timesteps can run concurrently
+
+    :param face_nodes: array of dim(n,3) of the nodes indexes of the triangle containing each point
+    :param bar_coord: array of dim(n,3) of the barycentric coordinates of each point
+    :param nodes_values: array of dim(Nnodes,) of values associated to the mesh nodes
+    :param out: array of dim(n,) where the interpolated values are written
+    """
+    for i in range(face_nodes.shape[0]):
+        out[i] = (bar_coord[i, 0] * nodes_values[face_nodes[i, 0]] +
+                  bar_coord[i, 1] * nodes_values[face_nodes[i, 1]] +
+                  bar_coord[i, 2] * nodes_values[face_nodes[i, 2]])
+
+
+def barycentric_interpolation(face_nodes, bar_coord, nodes_values):
+    """
+    This function computes the convex linear combination of the nodes values using the barycentric coordinates
+    returned by locate_pointCloud
+
+    :param face_nodes: array of dim(n,3) of the nodes indexes of the triangle containing each point
+    :param bar_coord: array of dim(n,3) of the barycentric coordinates of each point
+    :param nodes_values: array of dim(Nnodes,) of values associated to the mesh nodes
+    :return: array of interpolated values, with the precision of bar_coord
+    """
+    # the compiled kernel does not accept array subclasses such as numpy.ma.MaskedArray
+    face_nodes = np.asarray(face_nodes)
+    bar_coord = np.asarray(bar_coord)
+    nodes_values = np.asarray(nodes_values)
+    interpolated_values = np.empty(len(face_nodes), dtype=bar_coord.dtype)
+    barycentric_kernel(face_nodes, bar_coord, nodes_values, interpolated_values)
+    return interpolated_values
+
+
 def interpolate_pointCloud(points, mesh2d, nodes_values):
     """
     This function assign a value to a given 2D point (z=0) within an 2D-essentially mesh (z=0).
@@ -188,42 +378,8 @@ def interpolate_pointCloud(points, mesh2d, nodes_values):
     :param nodes_values: array of dim(Nnodes,) of values associated to the mesh2d nodes
     :return: array of interpolated values
     """
-    rays = trimesh.ray.ray_pyembree.RayMeshIntersector(mesh2d)  # ray object from pyembree
-    # Next line cast a ray from point in the z direction and get the triangle index that intersects
-    face_indexes = rays.intersects_first(points, np.array([[0., 0., 1.]]))  # list of triangles indexes
-    c = 0
-    interpolated_values = []
-    eps = 0.0000925925925926  # ~10m
-    if -1 in face_indexes:
-        pos = np.where(face_indexes == -1)
-        for i in pos[0]:
-            point_temp = points[i]
-            point_temp += eps
-            new_index = rays.intersects_first(np.array([point_temp]), np.array([[0., 0., 1.]]))[0]
-            face_indexes[i] = new_index
-
-    points = np.delete(points, 2, 1)
-    for index in range(0, len(face_indexes)):
-        face_nodes = mesh2d.faces[face_indexes[index]]  # get the nodes index of the face
-        node0_index = face_nodes[0]
-        node1_index = face_nodes[1]
-        node2_index = face_nodes[2]
-        node0coordinates = mesh2d.vertices[node0_index]  # get cartesian coordinates of node0
-        node1coordinates = mesh2d.vertices[node1_index]  # get cartesian coordinates of node1
-        node2coordinates = mesh2d.vertices[node2_index]  # get cartesian coordinates of node2
-        # Barycentric coordinates are invariants under plane-projections
-        node0coordinates = node0coordinates[:-1]  # remove last component
-        node1coordinates = node1coordinates[:-1]  # remove last component
-        node2coordinates = node2coordinates[:-1]  # remove last component
-        bar_coord = getBarycentricCoord(points[c], node0coordinates, node1coordinates, node2coordinates)
-        v0 = nodes_values[node0_index]  # get the associated value to the node0
-        v1 = nodes_values[node1_index]  # get the associated value to the node1
-        v2 = nodes_values[node2_index]  # get the associated value to the node2
-        interpolated_value = bar_coord[0] * v0 + bar_coord[1] * v1 + bar_coord[2] * v2
-        interpolated_values.append(interpolated_value)
-        c += 1
-    interpolated_values = np.array(interpolated_values)
-    return interpolated_values
+    face_nodes, bar_coord = locate_pointCloud(points, mesh2d.vertices[:, 0], mesh2d.vertices[:, 1], mesh2d.faces)
+    return barycentric_interpolation(face_nodes, bar_coord, nodes_values)
 
 
 def generate_grd(mesh2d, nodes_values, xres, yres, sw, ne, foutput):
@@ -239,17 +395,39 @@ def generate_grd(mesh2d, nodes_values, xres, yres, sw, ne, foutput):
     :param foutput: name of the output file
     :return: netCDF grid
     """
+    generate_grd_fromNodes(mesh2d.vertices[:, 0], mesh2d.vertices[:, 1], mesh2d.faces, nodes_values,
+                           xres, yres, sw, ne, foutput)
+    return
+
+
+def generate_grd_fromNodes(xs, ys, faces, nodes_values, xres, yres, sw, ne, foutput):
+    """
+    This function generates a grd structured grid from the x and y coordinates of the nodes of a 2D mesh and
+    its connectivity, without building a trimesh object
+
+    :param xs: 1D array of x coordinates of the mesh nodes
+    :param ys: 1D array of y coordinates of the mesh nodes
+    :param faces: array of dim(Nfaces,3) of the mesh connectivity
+    :param nodes_values: array of node values of the mesh that will be used to assign the final values
+    :param xres: x resolution of the out mesh
+    :param yres: y resolution of the out mesh
+    :param sw: lower left corner of the out mesh
+    :param ne: upper right corner of the out mesh
+    :param foutput: name of the output file
+    :return: netCDF grid
+    """
     x = np.arange(sw[0], ne[0], xres)  # partition in x
     y = np.arange(sw[1], ne[1], yres)  # partition in y
 
     Nrow = len(y)
     Ncolumn = len(x)
 
-    points = np.array(list(itertools.product(x, y)))     # Points of the grd to be interpolated
-    points = np.c_[points, (-1) * np.ones(len(points))]  # add z=-1 to each point to keep working on 3D
+    xx, yy = np.meshgrid(x, y)  # Points of the grd to be interpolated, row by row
+    points = np.column_stack([xx.ravel(), yy.ravel(), np.full(xx.size, -1.0)])  # add z=-1 to keep working on 3D
 
-    interpolated_values = interpolate_pointCloud(points, mesh2d, nodes_values)  # interpolate the values
-    interpolated_values = interpolated_values.reshape(Ncolumn, Nrow).T
+    face_nodes, bar_coord = locate_pointCloud(points, xs, ys, faces)
+    interpolated_values = barycentric_interpolation(face_nodes, bar_coord, nodes_values)  # interpolate the values
+    interpolated_values = interpolated_values.reshape(Nrow, Ncolumn)
     grdwrite(x, y, interpolated_values, foutput)  # ggenerate the final mesh
     return
 
@@ -269,7 +447,7 @@ def wgs_boundaries(sw, ne, inputcrs):
     ymin = sw[1]
     ymax = ne[1]
 
-    transformer = Transformer.from_crs(inputcrs, "epsg:4326", always_xy=True)
+    transformer = wgs84_transformer(inputcrs)
     xLL, yLL = transformer.transform(xmin, ymin)
     xUL, yUL = transformer.transform(xmin, ymax)
     xLR, yLR = transformer.transform(xmax, ymin)
@@ -284,38 +462,37 @@ def wgs_boundaries(sw, ne, inputcrs):
     return LL, UL, LR, UR
 
 
-def hysea_mesh_corners(mesh2d, inputcrs):
+def hysea_mesh_corners(mesh2d, inputcrs, nsamples=64):
     """
     This function takes the corners of the input mesh (mesh2d) and return the optimal SW, NE corners
-    for the transformed mesh in WGS84 coordinates
+    for the transformed mesh in WGS84 coordinates. The mesh edges are sampled with nsamples points, enough
+    for conformal projections where the extreme values lie at or near the corners
 
-    :param mesh2d: trimesh object of a mesh projected to z=0
+    :param mesh2d: trimesh object of the mesh. Only its horizontal bounds are used, so it does not need to be
+    projected to z=0
     :param inputcrs: CRS of the mesh2d
+    :param nsamples: number of points sampled along each edge of the mesh
     :return: two list SW, NE
     """
     sw = mesh2d.bounds[0][:2]  # Lower left corner
     ne = mesh2d.bounds[1][:2]  # Upper right corner
 
-    transformer = Transformer.from_crs(inputcrs, "epsg:4326", always_xy=True)
-
-    x = np.arange(sw[0], ne[0], 1)
-    y = np.arange(sw[1], ne[1], 1)
+    transformer = wgs84_transformer(inputcrs)
 
-    y_lowerRow = np.repeat(sw[1], len(x))
-    xnew, ynew = transformer.transform(x, y_lowerRow)
-    ymin = max(ynew)
+    x = np.linspace(sw[0], ne[0], nsamples)
+    y = np.linspace(sw[1], ne[1], nsamples)
 
-    y_upperRow = np.repeat(ne[1], len(x))
-    xnew, ynew = transformer.transform(x, y_upperRow)
-    ymax = min(ynew)
+    # lower row, upper row, left column and right column transformed at once
+    x_edges = np.concatenate([x, x, np.repeat(sw[0], nsamples), np.repeat(ne[0], nsamples)])
+    y_edges = np.concatenate([np.repeat(sw[1], nsamples), np.repeat(ne[1], nsamples), y, y])
+    xnew, ynew = transformer.transform(x_edges, y_edges)
+    xnew = np.reshape(xnew, (4, nsamples))
+    ynew = np.reshape(ynew, (4, nsamples))
 
-    x_leftColumn = np.repeat(sw[0], len(y))
-    xnew, ynew = transformer.transform(x_leftColumn, y)
-    xmin = max(xnew)
-
-    x_rightColumn = np.repeat(ne[0], len(y))
-    xnew, ynew = transformer.transform(x_rightColumn, y)
-    xmax = min(xnew)
+    ymin = ynew[0].max()
+    ymax = ynew[1].min()
+    xmin = xnew[2].max()
+    xmax = xnew[3].min()
 
     SW_new = [xmin, ymin]
     NE_new = [xmax, ymax]
@@ -334,12 +511,9 @@ def get_values_inside_rectangle(x, y, sw, ne):
     :param ne: NE corner
     :return: subsets of x and y inside the limits established by SW and NE
     """
-    indexMin = bisect.bisect_left(x, sw[0])  # retrieve index of first element greater than sw[0]
-    indexMax = bisect.bisect_left(x, ne[0])
-    x = x[indexMin:indexMax]
-    indexMin = bisect.bisect_left(y, sw[1])  # retrieve index of first element greater than sw[1]
-    indexMax = bisect.bisect_left(y, ne[1])
-    y = y[indexMin:indexMax]
+    # masks do not assume x, y are sorted (e.g. north-up rasters have decreasing y)
+    x = x[(x >= sw[0]) & (x < ne[0])]
+    y = y[(y >= sw[1]) & (y < ne[1])]
     return x, y
 
 
@@ -355,17 +529,16 @@ def generate_bathymetry(path2SeissolOutput, seissolevent_crs, outx_resolution, o
     :param outfile: name of the output file
     :return: structured bathymetry grid generated using seissol nodes
     """
-    mesh3d = generateMesh3DfromSeissol(path2SeissolOutput)
+    mesh3d, xs_wgs, ys_wgs = load_meshes(path2SeissolOutput, seissolevent_crs)
     bathy = mesh3d.vertices[:, 2]
-    mesh2d = generateMesh2DfromSeissol(path2SeissolOutput)
-    mesh2d_wgs = mesh2dCRSconversion(mesh2d, seissolevent_crs)
-    SW, NE = hysea_mesh_corners(mesh2d, seissolevent_crs)
-    generate_grd(mesh2d_wgs, bathy, outx_resolution, outy_resolution, SW, NE, outfile)
+    SW, NE = hysea_mesh_corners(mesh3d, seissolevent_crs)
+    generate_grd_fromNodes(xs_wgs, ys_wgs, mesh3d.faces, bathy, outx_resolution, outy_resolution, SW, NE, outfile)
     return
 
 
 def seissol2hysea(path2SeissolOutput, seissolevent_crs, outnetcdf, instants=[], outx_resolution=None,
-                        outy_resolution=None, only_vertical=False, raster_file=None, points_given=None):
+                        outy_resolution=None, only_vertical=False, raster_file=None, points_given=None,
+                        float_precision='f4'):
     """
     This function convert the Seissol model output to a structured mesh in netcdf format. The resulting netCDF
     contains information about the displacements u1,u2,u3 on each time step. The order of kwargs arguments is: first
@@ -383,6 +556,8 @@ def seissol2hysea(path2SeissolOutput, seissolevent_crs, outnetcdf, instants=[],
     :param raster_file: if provided, points location will be used to generate the netCDF (formats are .nc, .tif, .grd)
     :param points_given: if provided, points location will be used to generate the netCDF. It is a list [x,y],
     where x,y are ndarrays of the longitude and latitude coordinates, resp.
+    :param float_precision: precision of the interpolated displacements, 'f4' (single) or 'f8' (double). It sets the
+    precision of the barycentric coordinates, of the interpolated values and of their storage in the netCDF
 
     :return: netCDF file
     """
@@ -401,32 +576,35 @@ def seissol2hysea(path2SeissolOutput, seissolevent_crs, outnetcdf, instants=[],
     else:
         variables = ["u1", "u2", "u3"]
 
+    # 3d mesh and its nodes coordinates in WGS84, both generated from a single read of the geometry
+    mesh3d, xs_wgs, ys_wgs = load_meshes(path2SeissolOutput, seissolevent_crs)
+
     # First we need the arrays containing the interpolation associated to the nodes
     if not os.path.exists("nodes_arrays"):
         os.mkdir("nodes_arrays")
 
     nodes2generate = []
 
-    for (var, t) in list(itertools.product(variables, instants)):
-        # check if nodes arrays already exists
-        name = "node_values_{}_timestep{}.npy".format(var, t)
-        if not os.path.exists(os.path.join("nodes_arrays", name)):
-            nodes2generate.append((var, t))
+    for var in variables:
+        # check if nodes arrays already exists and belong to this SeisSol output
+        name = os.path.join("nodes_arrays", "node_values_{}.npy".format(var))
+        if not os.path.exists(name):
+            nodes2generate.append(var)
+        elif np.load(name, mmap_mode='r').shape != (ndt, len(mesh3d.vertices)):
+            print("nodes array of {} does not match the SeisSol output, it will be generated again".format(var))
+            nodes2generate.append(var)
 
     if nodes2generate:
         # Generate the arrays containing the variables values assigned to the nodes in case they don't exist
-        mesh3d = generateMesh3DfromSeissol(path2SeissolOutput)
-        for (var, t) in nodes2generate:
-            print("generating array of nodes values for {}-timestep {}".format(var, t))
-            assign_nodes_values(path2SeissolOutput, mesh3d, var, t)
+        weights = nodes_weights_matrix(mesh3d)  # shared by all the variables
+        for var in nodes2generate:
+            print("generating array of nodes values for {}".format(var))
+            assign_nodes_values(path2SeissolOutput, mesh3d, var, weights)
         print("All nodes values arrays have been generated successfully")
     else:
         print("All nodes values arrays already exist")
 
-    mesh2d = generateMesh2DfromSeissol(path2SeissolOutput)      # generate the 2d mesh object
-    mesh2d_wgs = mesh2dCRSconversion(mesh2d, seissolevent_crs)  # create new 2d mesh with nodes CRS in WGS84
-
-    SW, NE = hysea_mesh_corners(mesh2d, seissolevent_crs)  # Optimal corners of the resulting mesh
+    SW, NE = hysea_mesh_corners(mesh3d, seissolevent_crs)  # Optimal corners of the resulting mesh
     # Now define the structured mesh for HySEA
     if points_given is not None:
         print("points arrays given")
@@ -445,10 +623,10 @@ def seissol2hysea(path2SeissolOutput, seissolevent_crs, outnetcdf, instants=[],
             yaxis = ["lat", "y", "latitude"]
             for namex in var_names:
                 if namex in xaxis:
-                    x = ds[namex][:]
+                    x = np.ma.getdata(ds[namex][:])  # plain array, the axes are never masked
             for namey in var_names:
                 if namey in yaxis:
-                    y = ds[namey][:]
+                    y = np.ma.getdata(ds[namey][:])  # plain array, the axes are never masked
             x, y = get_values_inside_rectangle(x, y, SW, NE)    # get the subset inside the optimal corners
             ds.close()
         elif extension == "tif":
@@ -474,8 +652,13 @@ def seissol2hysea(path2SeissolOutput, seissolevent_crs, outnetcdf, instants=[],
 
     Nrow = len(y)
     Ncolumn = len(x)
-    points = np.array(list(itertools.product(x, y)))        # Points of the grd to be interpolated
-    points = np.c_[points, (-1) * np.ones(len(points))]     # add z=-1 to each point to keep working on 3D
+    xx, yy = np.meshgrid(x, y)  # Points of the grd to be interpolated, row by row
+    points = np.column_stack([xx.ravel(), yy.ravel(), np.full(xx.size, -1.0)])  # add z=-1 to keep working on 3D
+
+    # The points location within the mesh does not change between timesteps and variables
+    face_nodes, bar_coord = locate_pointCloud(points, xs_wgs, ys_wgs, mesh3d.faces)
+    # the points are located in double precision, the barycentric coordinates and the results use float_precision
+    bar_coord = bar_coord.astype(float_precision, copy=False)
 
     # Now create the netCDF file and fill it
     ds = Dataset(outnetcdf, 'w', format='NETCDF4')
@@ -495,32 +678,29 @@ def seissol2hysea(path2SeissolOutput, seissolevent_crs, outnetcdf, instants=[],
     longitude[:] = x
     latitude[:] = y
 
-    if only_vertical:
-        u3 = ds.createVariable('u3', 'f8', ('time', 'y', 'x'))
-        u3.units = "meters"
-        for t in instants:
-            print("including variable u3-timestep{} in netCDF".format(t))
-            array = os.path.join("nodes_arrays", "node_values_u3_timestep{}.npy".format(t))
-            nodes_values = np.load(array)
-            interpolated_values = interpolate_pointCloud(points, mesh2d_wgs, nodes_values)
-            interpolated_values = interpolated_values.reshape(Ncolumn, Nrow).T
-            u3[t, :, :] = interpolated_values
-    else:
-        u1 = ds.createVariable('u1', 'f8', ('time', 'y', 'x'))
-        u2 = ds.createVariable('u2', 'f8', ('time', 'y', 'x'))
-        u3 = ds.createVariable('u3', 'f8', ('time', 'y', 'x'))
-        u1.units = "meters"
-        u2.units = "meters"
-        u3.units = "meters"
-        dic = {"u1": u1, "u2": u2, "u3": u3}
-        for t in instants:
-            for variable in variables:
-                print("including variable {}-timestep{} in netCDF".format(variable, t))
-                array = os.path.join("nodes_arrays", "node_values_{}_timestep{}.npy".format(variable, t))
-                nodes_values = np.load(array)
-                interpolated_values = interpolate_pointCloud(points, mesh2d_wgs, nodes_values)
-                interpolated_values = interpolated_values.reshape(Ncolumn, Nrow).T
-                dic[variable][t, :, :] = interpolated_values
+    dic = {}
+    for variable in variables:
+        # one chunk per timestep, so each of them is compressed and flushed to disk independently
+        dic[variable] = ds.createVariable(variable, float_precision, ('time', 'y', 'x'), zlib=True, complevel=4,
+                                          chunksizes=(1, Nrow, Ncolumn))
+        dic[variable].units = "meters"
+    # arrays of dim(ndt, Nnodes), mapped once. Only the nodes of the located faces are read
+    nodes_arrays = {variable: np.load(os.path.join("nodes_arrays", "node_values_{}.npy".format(variable)),
+                                      mmap_mode='r') for variable in variables}
+    lock = threading.Lock()  # netCDF4 is not thread-safe, so the writes are serialized
+
+    def include_timestep(variable, t):
+        print("including variable {}-timestep{} in netCDF".format(variable, t))
+        interpolated_values = barycentric_interpolation(face_nodes, bar_coord, nodes_arrays[variable][t])
+        with lock:
+            dic[variable][t, :, :] = interpolated_values.reshape(Nrow, Ncolumn)
+            ds.sync()
+
+    # Each (timestep, variable) pair is independent and fills its own slab of the netCDF
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(include_timestep, variable, t) for t in instants for variable in variables]
+        for future in futures:
+            future.result()  # raise the exceptions of the workers, if any
 
     ds.close()
     return